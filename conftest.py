@@ -0,0 +1,31 @@
+"""
+Test configuration - runs the test suite against an in-memory SQLite database
+Set TEST_USE_DATABASE_URL=1 to run it against DATABASE_URL (PostgreSQL) instead
+
+Usage: pytest -n auto  (each xdist worker gets its own in-memory database)
+"""
+
+import os
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import StaticPool
+import main
+
+if os.getenv("TEST_USE_DATABASE_URL", "").lower() not in ("1", "true", "yes"):
+    # One shared connection (StaticPool) keeps the in-memory database alive across sessions
+    # and lets the TestClient's worker threads use it; test_calculations creates the tables
+    main.engine = create_engine(
+        "sqlite+pysqlite:///:memory:",
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool
+    )
+    main.SessionLocal.configure(bind=main.engine)
+    
+    # pysqlite's own transaction handling breaks SAVEPOINT, which the tests' rolled-back
+    # transactions rely on; let SQLAlchemy emit BEGIN itself instead
+    @event.listens_for(main.engine, "connect")
+    def disable_pysqlite_transactions(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+    
+    @event.listens_for(main.engine, "begin")
+    def begin_transaction(conn):
+        conn.exec_driver_sql("BEGIN")
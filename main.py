@@ -1,13 +1,22 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Depends, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from sqlalchemy import create_engine, Column, Integer, Numeric, DateTime, String, ForeignKey, text, or_
+from fastapi.middleware.gzip import GZipMiddleware
+from starlette.datastructures import Headers
+from fastapi.responses import ORJSONResponse, Response
+from pydantic import BaseModel, TypeAdapter
+from sqlalchemy import create_engine, Column, Integer, Numeric, DateTime, String, ForeignKey, text, or_, select, insert, func, case, type_coerce, Index, lambda_stmt, Computed
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm import sessionmaker, relationship, Session
+from sqlalchemy.pool import NullPool
 from datetime import datetime
 from decimal import Decimal
 from typing import List, Optional
 import os
+import time
+import gzip
+import threading
+import anyio
+import orjson
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -25,20 +34,61 @@ if not DATABASE_URL:
 else:
     print(f"✓ DATABASE_URL found (length: {len(DATABASE_URL)})")
 
-# Render uses postgres:// format, convert to postgresql://
+# Render uses postgres:// format; use the psycopg (v3) driver for plain postgres URLs
 if DATABASE_URL.startswith("postgres://"):
     DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
+if DATABASE_URL.startswith("postgresql://"):
+    DATABASE_URL = DATABASE_URL.replace("postgresql://", "postgresql+psycopg://", 1)
+
+# Connection pool size - sync endpoints run in a worker threadpool of the same size,
+# so every in-flight request can hold a connection without waiting on the pool
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+# Pre-ping costs a round trip per checkout; it can be turned off when the database is
+# reliable (keepalives and pool_recycle already retire dead connections)
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "1").lower() in ("1", "true", "yes")
+
+# Behind PgBouncer (transaction pooling) connections are pooled by PgBouncer, so the app
+# opens a connection per session instead of keeping its own pool in every worker
+USE_PGBOUNCER = os.getenv("USE_PGBOUNCER", "").lower() in ("1", "true", "yes")
+if USE_PGBOUNCER:
+    pool_options = {"poolclass": NullPool}
+else:
+    pool_options = {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": 30,     # Wait up to 30 seconds for a free connection
+        "pool_pre_ping": DB_POOL_PRE_PING,  # Verify connections before using
+        "pool_recycle": 1800    # Recycle connections after 30 minutes
+    }
 
 # Create engine with connection pooling and retry logic
 engine = create_engine(
     DATABASE_URL,
-    pool_pre_ping=True,  # Verify connections before using
-    pool_recycle=300,    # Recycle connections after 5 minutes
-    connect_args={"connect_timeout": 10}  # 10 second timeout
+    connect_args={
+        "connect_timeout": 10,  # 10 second timeout
+        # TCP keepalives so idle pooled connections aren't silently dropped by NAT/proxies
+        "keepalives": 1,
+        "keepalives_idle": 30,
+        "keepalives_interval": 10,
+        "keepalives_count": 5,
+        # Prepare a statement server-side once it has run 5 times on a connection;
+        # PgBouncer's transaction pooling can't track prepared statements, so not there
+        "prepare_threshold": None if USE_PGBOUNCER else 5
+    },
+    **pool_options
 )
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
+def get_db():
+    """Request-scoped database session, closed by FastAPI once the request is done"""
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
 # SQLAlchemy Models
 class Inventory(Base):
     __tablename__ = "inventory"
@@ -49,9 +99,15 @@ class Inventory(Base):
     design_code = Column(String(100), nullable=False)
     total_thans = Column(Numeric(10, 2), nullable=False)
     meters_per_than = Column(Numeric(10, 2), nullable=False)
-    total_meters = Column(Numeric(10, 2), nullable=False)
+    # Derived columns - computed and stored by the database from the columns above
+    total_meters = Column(Numeric(10, 2), Computed("total_thans * meters_per_than", persisted=True))
     cost_price_per_meter = Column(Numeric(10, 2), nullable=False)
-    total_stock_value = Column(Numeric(10, 2), nullable=False)
+    total_stock_value = Column(
+        Numeric(10, 2),
+        Computed("total_thans * meters_per_than * cost_price_per_meter", persisted=True)
+    )
+    # Running total of meters sold from this item, kept up to date by the bill endpoints
+    sold_meters = Column(Numeric(10, 2), nullable=False, default=0, server_default="0")
     created_at = Column(DateTime, default=datetime.utcnow)
 
 class SalesRecord(Base):
@@ -60,8 +116,8 @@ class SalesRecord(Base):
     id = Column(Integer, primary_key=True, index=True)
     product_category = Column(String(50), nullable=False, default='two_piece_suits')  # Category for this sale
     inventory_id = Column(Integer, ForeignKey("inventory.id"), nullable=True)  # Keep for backward compatibility
-    kameez_inventory_id = Column(Integer, ForeignKey("inventory.id"), nullable=True)
-    shalwar_inventory_id = Column(Integer, ForeignKey("inventory.id"), nullable=True)
+    kameez_inventory_id = Column(Integer, ForeignKey("inventory.id"), nullable=True, index=True)
+    shalwar_inventory_id = Column(Integer, ForeignKey("inventory.id"), nullable=True, index=True)
     company_name = Column(String(255), nullable=True)
     design_code = Column(String(100), nullable=True)
     kameez_company_name = Column(String(255), nullable=True)
@@ -76,87 +132,176 @@ class SalesRecord(Base):
     shalwar_total = Column(Numeric(10, 2))
     grand_total = Column(Numeric(10, 2))
     created_at = Column(DateTime, default=datetime.utcnow)
-
-# Create tables - will be done on startup to ensure database is ready
-# Don't create tables at module import time
-
-# Migration function to add new columns if they don't exist
-def migrate_database():
-    """Add new columns to sales_records table if they don't exist"""
-    try:
-        with engine.begin() as conn:
-            # Check existing columns
-            result = conn.execute(text("""
-                SELECT column_name 
-                FROM information_schema.columns 
-                WHERE table_name='sales_records'
-            """))
-            existing_columns = [row[0] for row in result.fetchall()]
-            
-            columns_to_add = {
-                'inventory_id': 'INTEGER REFERENCES inventory(id)',
-                'company_name': 'VARCHAR(255)',
-                'design_code': 'VARCHAR(100)',
-                'kameez_inventory_id': 'INTEGER REFERENCES inventory(id)',
-                'shalwar_inventory_id': 'INTEGER REFERENCES inventory(id)',
-                'kameez_company_name': 'VARCHAR(255)',
-                'kameez_design_code': 'VARCHAR(100)',
-                'shalwar_company_name': 'VARCHAR(255)',
-                'shalwar_design_code': 'VARCHAR(100)',
-                'product_category': 'VARCHAR(50) DEFAULT \'two_piece_suits\''
-            }
-            
-            # Also add product_category to inventory table
-            inv_result = conn.execute(text("""
-                SELECT column_name 
-                FROM information_schema.columns 
-                WHERE table_name='inventory'
-            """))
-            inv_existing_columns = [row[0] for row in inv_result.fetchall()]
-            
-            if 'product_category' not in inv_existing_columns:
+    line_items = relationship("SalesLineItem")
+    
+    __table_args__ = (
+        # inventory_id is only set on old-method sales, so keep its index partial
+        Index(
+            "ix_sales_records_inventory_id", "inventory_id",
+            postgresql_where=text("inventory_id IS NOT NULL"),
+            sqlite_where=text("inventory_id IS NOT NULL")
+        ),
+    )
+
+class SalesLineItem(Base):
+    __tablename__ = "sales_line_items"
+    
+    # One row per inventory item a sale takes cloth from (kameez and shalwar pieces alike),
+    # so per-item totals are a single GROUP BY instead of one branch per piece
+    id = Column(Integer, primary_key=True, index=True)
+    sale_id = Column(Integer, ForeignKey("sales_records.id"), nullable=False, index=True)
+    inventory_id = Column(Integer, ForeignKey("inventory.id"), nullable=False)
+    meters = Column(Numeric(10, 2), nullable=False)
+    rate = Column(Numeric(10, 2), nullable=False)
+    
+    __table_args__ = (
+        # Covering index for the per-item meters/revenue sums
+        Index("ix_sales_line_items_inventory_id_meters_rate", "inventory_id", "meters", "rate"),
+    )
+
+def sale_line_items(sale):
+    """Line items (inventory_id, meters, rate) for a sale's column values"""
+    if sale["kameez_inventory_id"] or sale["shalwar_inventory_id"]:
+        pieces = [
+            (sale["kameez_inventory_id"], sale["kameez_meters"], sale["kameez_rate"]),
+            (sale["shalwar_inventory_id"], sale["shalwar_meters"], sale["shalwar_rate"])
+        ]
+    else:
+        # Old method: both kameez and shalwar are cut from inventory_id
+        pieces = [
+            (sale["inventory_id"], sale["kameez_meters"], sale["kameez_rate"]),
+            (sale["inventory_id"], sale["shalwar_meters"], sale["shalwar_rate"])
+        ]
+    return [
+        {"inventory_id": inventory_id, "meters": meters or 0, "rate": rate or 0}
+        for inventory_id, meters, rate in pieces if inventory_id
+    ]
+
+def sales_totals_subquery():
+    """Total sold meters and sales revenue per inventory id, aggregated in the database"""
+    return select(
+        SalesLineItem.inventory_id,
+        func.sum(SalesLineItem.meters).label("sold_meters"),
+        # Unscaled Numeric so revenue isn't rounded to the columns' 2 places
+        func.sum(type_coerce(SalesLineItem.meters * SalesLineItem.rate, Numeric())).label("revenue")
+    ).group_by(SalesLineItem.inventory_id).subquery("sales_totals")
+
+# Built once; SQLAlchemy caches its compiled SQL across requests
+SALES_TOTALS = sales_totals_subquery()
+
+def find_inventory_item(db, inventory_id):
+    """Get an inventory row by id (lambda statement, so the SELECT is built and compiled once)"""
+    return db.execute(
+        lambda_stmt(lambda: select(Inventory).where(Inventory.id == inventory_id))
+    ).scalar_one_or_none()
+
+def lock_inventory_items(db, inventory_ids):
+    """Lock inventory rows (SELECT ... FOR UPDATE) until the transaction ends, keyed by id"""
+    # Always lock in id order so two concurrent bills can't deadlock each other
+    ids = sorted({inventory_id for inventory_id in inventory_ids if inventory_id})
+    if not ids:
+        return {}
+    items = db.execute(
+        select(Inventory).where(Inventory.id.in_(ids)).order_by(Inventory.id).with_for_update()
+    ).scalars()
+    return {item.id: item for item in items}
+
+# Short-lived per-process cache of serialized list responses, keyed by (endpoint, category).
+# Write endpoints clear it; with several workers other processes may lag by up to the TTL.
+INVENTORY_CACHE_TTL = float(os.getenv("INVENTORY_CACHE_TTL", "5"))
+PROFIT_LOSS_CACHE_TTL = float(os.getenv("PROFIT_LOSS_CACHE_TTL", "30"))
+_response_cache = {}
+# Bumped on every invalidation, so a read that started before a write can't cache its stale result
+_response_cache_generation = 0
+_response_cache_lock = threading.Lock()
+
+# Responses smaller than this aren't worth compressing (also used by GZipMiddleware)
+GZIP_MINIMUM_SIZE = 500
+
+def accepts_gzip(headers):
+    """Whether the Accept-Encoding header allows gzip (a gzip token without q=0)"""
+    for token in headers.get("Accept-Encoding", "").split(","):
+        coding, *params = [part.strip() for part in token.split(";")]
+        if coding.lower() != "gzip":
+            continue
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
                 try:
-                    conn.execute(text("ALTER TABLE inventory ADD COLUMN product_category VARCHAR(50) DEFAULT 'two_piece_suits'"))
-                    print("✓ Added product_category to inventory table")
-                except Exception as e:
-                    if "already exists" not in str(e).lower():
-                        print(f"⚠ Warning adding product_category to inventory: {str(e)}")
-            
-            added_columns = []
-            for col_name, col_type in columns_to_add.items():
-                if col_name not in existing_columns:
-                    try:
-                        conn.execute(text(f"ALTER TABLE sales_records ADD COLUMN {col_name} {col_type}"))
-                        added_columns.append(col_name)
-                    except Exception as e:
-                        if "already exists" not in str(e).lower():
-                            print(f"⚠ Warning adding {col_name}: {str(e)}")
-            
-            if added_columns:
-                print(f"✓ Database migration completed: Added columns {', '.join(added_columns)}")
-            else:
-                print("✓ Database is up to date - all columns exist")
-    except Exception as e:
-        error_msg = str(e).lower()
-        if "already exists" in error_msg or "duplicate" in error_msg:
-            print("✓ Database is up to date - columns already exist")
-        else:
-            print(f"⚠ Migration warning: {str(e)}")
-
-# FastAPI app
-app = FastAPI()
-
-# Run migration on startup
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+class AcceptEncodingGZipMiddleware(GZipMiddleware):
+    """GZipMiddleware that honours gzip;q=0 (Starlette only checks for a "gzip" substring)"""
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and not accepts_gzip(Headers(scope=scope)):
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+def cached_json_response(entry, request):
+    """Response for a cache entry - the pre-compressed bytes if the client accepts gzip"""
+    _, content, gzipped = entry
+    if gzipped and accepts_gzip(request.headers):
+        # Content-Encoding is already set, so GZipMiddleware passes this through as is
+        return Response(
+            content=gzipped,
+            media_type="application/json",
+            headers={"Content-Encoding": "gzip", "Vary": "Accept-Encoding"}
+        )
+    # Vary on the plain variant too, so shared caches keep the two encodings apart
+    return Response(content=content, media_type="application/json", headers={"Vary": "Accept-Encoding"})
+
+def get_cached_response(key, request):
+    """Return the cached JSON response for key, or None if it's missing or expired"""
+    cached = _response_cache.get(key)
+    if cached and time.monotonic() < cached[0]:
+        return cached_json_response(cached, request)
+    return None
+
+def response_cache_generation():
+    """Current cache generation - read it before querying the data to be cached"""
+    return _response_cache_generation
+
+def cache_response(key, content, ttl, request, generation):
+    """Cache JSON bytes (and their gzip encoding) under key for ttl seconds and return them as a response"""
+    # Compressed once here, not on every cache hit
+    gzipped = gzip.compress(content) if len(content) >= GZIP_MINIMUM_SIZE else None
+    entry = (time.monotonic() + ttl, content, gzipped)
+    with _response_cache_lock:
+        # Stock or sales changed while the data was being read - serve it, but don't cache it
+        if generation == _response_cache_generation:
+            _response_cache[key] = entry
+    return cached_json_response(entry, request)
+
+def invalidate_response_cache():
+    """Drop cached responses after stock or sales change"""
+    global _response_cache_generation
+    with _response_cache_lock:
+        _response_cache_generation += 1
+        _response_cache.clear()
+
+# Tables are created and migrated by migrate.py, run once per deploy
+# Don't create tables at module import time or on every worker startup
+
+# FastAPI app - responses are encoded with orjson (C extension) instead of the stdlib json module
+app = FastAPI(default_response_class=ORJSONResponse)
+
+# Check the database on startup - schema changes are applied by migrate.py
 @app.on_event("startup")
 async def startup_event():
-    """Run database migration on application startup"""
+    """Verify the database connection on application startup"""
+    # Sync (def) endpoints run in AnyIO's threadpool (40 threads by default);
+    # match it to the connection pool so threads don't queue for connections
+    anyio.to_thread.current_default_thread_limiter().total_tokens = DB_POOL_SIZE + DB_MAX_OVERFLOW
+    
     try:
-        # Create tables first
-        Base.metadata.create_all(bind=engine)
-        print("✓ Database tables created/verified")
-        
-        # Then run migration
-        migrate_database()
+        with engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+        print("✓ Database connection verified")
     except Exception as e:
         print(f"⚠ Database connection error on startup: {str(e)}")
         print("⚠ Will retry on first request...")
@@ -173,6 +318,9 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Compress larger responses (the JSON lists repeat the same keys on every row)
+app.add_middleware(AcceptEncodingGZipMiddleware, minimum_size=GZIP_MINIMUM_SIZE)
+
 # Serve static files (HTML, CSS, JS)
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse
@@ -182,76 +330,74 @@ import os
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
 def get_file_path(filename):
-    """Get absolute path for a file in the project directory"""
+    """Get absolute path for a file in the project directory, or None if it doesn't exist"""
     file_path = os.path.join(BASE_DIR, filename)
+    if os.path.exists(file_path):
+        return file_path
     # Also try current working directory as fallback
-    if not os.path.exists(file_path):
-        cwd_path = os.path.join(os.getcwd(), filename)
-        if os.path.exists(cwd_path):
-            return cwd_path
-    return file_path
+    cwd_path = os.path.join(os.getcwd(), filename)
+    if os.path.exists(cwd_path):
+        return cwd_path
+    return None
+
+# Frontend files are resolved and stat'ed once at import (restart the app after editing them),
+# so requests don't pay for path lookups or the stat FileResponse would otherwise do
+STATIC_FILES = {}
+for filename in ("index.html", "admin.html", "config.js"):
+    file_path = get_file_path(filename)
+    if file_path:
+        STATIC_FILES[filename] = (file_path, os.stat(file_path))
+
+def serve_file(filename, media_type=None):
+    """Return a project file as a FileResponse, 404 if it's missing"""
+    if filename not in STATIC_FILES:
+        raise HTTPException(status_code=404, detail=f"{filename} not found")
+    file_path, stat_result = STATIC_FILES[filename]
+    return FileResponse(file_path, stat_result=stat_result, media_type=media_type)
 
 @app.get("/")
 async def read_root():
-    file_path = get_file_path("index.html")
-    if not os.path.exists(file_path):
-        raise HTTPException(status_code=404, detail="index.html not found")
-    return FileResponse(file_path)
+    return serve_file("index.html")
 
 @app.get("/index.html")
 async def index_html():
-    file_path = get_file_path("index.html")
-    if not os.path.exists(file_path):
-        raise HTTPException(status_code=404, detail="index.html not found")
-    return FileResponse(file_path)
+    return serve_file("index.html")
 
 @app.get("/admin")
 async def admin_page():
     """Serve admin page - category selection"""
-    file_path = get_file_path("admin.html")
-    if not os.path.exists(file_path):
-        raise HTTPException(status_code=404, detail="admin.html not found")
-    return FileResponse(file_path)
+    return serve_file("admin.html")
 
 @app.get("/admin/{category}")
 async def admin_category_page(category: str):
     """Serve admin page for specific category - same HTML file, JavaScript handles category"""
-    file_path = get_file_path("admin.html")
-    if not os.path.exists(file_path):
-        raise HTTPException(status_code=404, detail="admin.html not found")
-    return FileResponse(file_path)
+    return serve_file("admin.html")
 
 @app.get("/sales/{category}")
 async def sales_category_page(category: str):
     """Serve sales page for specific category - same HTML file, JavaScript handles category"""
-    file_path = get_file_path("index.html")
-    if not os.path.exists(file_path):
-        raise HTTPException(status_code=404, detail="index.html not found")
-    return FileResponse(file_path)
+    return serve_file("index.html")
 
 @app.get("/config.js")
 async def config_js():
-    file_path = get_file_path("config.js")
-    if not os.path.exists(file_path):
-        raise HTTPException(status_code=404, detail="config.js not found")
-    return FileResponse(file_path, media_type="application/javascript")
+    return serve_file("config.js", media_type="application/javascript")
 
 # Pydantic models for request/response
 class StockCreate(BaseModel):
     product_category: str = 'two_piece_suits'  # Default to two_piece_suits
     company_name: str
     design_code: str
-    total_thans: float
-    meters_per_than: float
-    cost_price_per_meter: float
+    total_thans: Decimal
+    meters_per_than: Decimal
+    cost_price_per_meter: Decimal
 
 class StockUpdate(BaseModel):
     product_category: Optional[str] = None
     company_name: Optional[str] = None
     design_code: Optional[str] = None
-    total_thans: Optional[float] = None
-    meters_per_than: Optional[float] = None
-    cost_price_per_meter: Optional[float] = None
+    total_thans: Optional[Decimal] = None
+    meters_per_than: Optional[Decimal] = None
+    cost_price_per_meter: Optional[Decimal] = None
 
 class InventoryResponse(BaseModel):
     id: int
@@ -282,6 +428,22 @@ class InventoryStatus(BaseModel):
     remaining_meters: Decimal
     remaining_stock_value: Decimal
 
+# Serializer for /get-inventory - the rows are built from trusted DB values, so the
+# endpoint skips validation and dumps them straight to JSON
+INVENTORY_STATUS_LIST = TypeAdapter(List[InventoryStatus])
+
+# Documents the /get-profit-loss rows; the endpoint returns pre-serialized JSON, so it
+# is never used for validation. Numbers are floats (the admin page calls toFixed on them)
+class ProfitLossItem(BaseModel):
+    company_name: str
+    design_code: str
+    meters_sold: float
+    cost_price_per_meter: float
+    total_cost: float
+    total_revenue: float
+    profit: float
+    profit_percentage: float
+
 class BillCreate(BaseModel):
     product_category: str = 'two_piece_suits'  # Category for this sale
     inventory_id: Optional[int] = None  # For backward compatibility
@@ -293,10 +455,10 @@ class BillCreate(BaseModel):
     kameez_design_code: Optional[str] = None
     shalwar_company_name: Optional[str] = None
     shalwar_design_code: Optional[str] = None
-    kameez_meters: float
-    kameez_rate: float
-    shalwar_meters: float
-    shalwar_rate: float
+    kameez_meters: Decimal
+    kameez_rate: Decimal
+    shalwar_meters: Decimal
+    shalwar_rate: Decimal
 
 class BillResponse(BaseModel):
     id: int
@@ -322,30 +484,22 @@ class BillResponse(BaseModel):
         from_attributes = True
 
 @app.post("/add-stock", response_model=InventoryResponse)
-def add_stock(stock: StockCreate):
+def add_stock(stock: StockCreate, db: Session = Depends(get_db)):
     try:
-        db = SessionLocal()
-        
-        # Calculate total meters and stock value
-        total_meters = Decimal(str(stock.total_thans)) * Decimal(str(stock.meters_per_than))
-        total_stock_value = total_meters * Decimal(str(stock.cost_price_per_meter))
-        
-        # Create inventory record
+        # total_meters and total_stock_value are computed by the database
         inventory = Inventory(
             product_category=stock.product_category,
             company_name=stock.company_name,
             design_code=stock.design_code,
-            total_thans=Decimal(str(stock.total_thans)),
-            meters_per_than=Decimal(str(stock.meters_per_than)),
-            total_meters=total_meters,
-            cost_price_per_meter=Decimal(str(stock.cost_price_per_meter)),
-            total_stock_value=total_stock_value
+            total_thans=stock.total_thans,
+            meters_per_than=stock.meters_per_than,
+            cost_price_per_meter=stock.cost_price_per_meter
         )
         
         db.add(inventory)
         db.commit()
+        invalidate_response_cache()
         db.refresh(inventory)
-        db.close()
         
         return inventory
         
@@ -353,13 +507,10 @@ def add_stock(stock: StockCreate):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.put("/update-stock/{stock_id}", response_model=InventoryResponse)
-def update_stock(stock_id: int, stock_update: StockUpdate):
-    db = None
+def update_stock(stock_id: int, stock_update: StockUpdate, db: Session = Depends(get_db)):
     try:
-        db = SessionLocal()
-        
         # Get existing inventory
-        inventory = db.query(Inventory).filter(Inventory.id == stock_id).first()
+        inventory = find_inventory_item(db, stock_id)
         if not inventory:
             raise HTTPException(status_code=404, detail="Stock item not found")
         
@@ -371,17 +522,15 @@ def update_stock(stock_id: int, stock_update: StockUpdate):
         if stock_update.design_code is not None:
             inventory.design_code = stock_update.design_code
         if stock_update.total_thans is not None:
-            inventory.total_thans = Decimal(str(stock_update.total_thans))
+            inventory.total_thans = stock_update.total_thans
         if stock_update.meters_per_than is not None:
-            inventory.meters_per_than = Decimal(str(stock_update.meters_per_than))
+            inventory.meters_per_than = stock_update.meters_per_than
         if stock_update.cost_price_per_meter is not None:
-            inventory.cost_price_per_meter = Decimal(str(stock_update.cost_price_per_meter))
-        
-        # Recalculate total meters and stock value
-        inventory.total_meters = inventory.total_thans * inventory.meters_per_than
-        inventory.total_stock_value = inventory.total_meters * inventory.cost_price_per_meter
+            inventory.cost_price_per_meter = stock_update.cost_price_per_meter
         
+        # total_meters and total_stock_value are recalculated by the database on commit
         db.commit()
+        invalidate_response_cache()
         db.refresh(inventory)
         
         return inventory
@@ -390,42 +539,36 @@ def update_stock(stock_id: int, stock_update: StockUpdate):
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        if db:
-            db.close()
 
 @app.delete("/delete-stock/{stock_id}")
-def delete_stock(stock_id: int):
-    db = None
+def delete_stock(stock_id: int, db: Session = Depends(get_db)):
     try:
-        db = SessionLocal()
-        
         # Get inventory item
-        inventory = db.query(Inventory).filter(Inventory.id == stock_id).first()
+        inventory = find_inventory_item(db, stock_id)
         if not inventory:
-            db.close()
             raise HTTPException(status_code=404, detail=f"Stock item with ID {stock_id} not found")
         
-        # Check if there are any sales records linked to this inventory
-        # Use or_() for proper SQL OR clause
-        from sqlalchemy import or_
-        sales_count = db.query(SalesRecord).filter(
-            or_(
-                SalesRecord.inventory_id == stock_id,
-                SalesRecord.kameez_inventory_id == stock_id,
-                SalesRecord.shalwar_inventory_id == stock_id
-            )
-        ).count()
+        # Check if any sales record is linked to this inventory (EXISTS stops at the first match)
+        has_sales = db.query(
+            db.query(SalesRecord).filter(
+                or_(
+                    SalesRecord.inventory_id == stock_id,
+                    SalesRecord.kameez_inventory_id == stock_id,
+                    SalesRecord.shalwar_inventory_id == stock_id
+                )
+            ).exists()
+        ).scalar()
         
-        if sales_count > 0:
+        if has_sales:
             raise HTTPException(
                 status_code=400,
-                detail=f"Cannot delete stock item. {sales_count} sales record(s) are linked to this inventory."
+                detail="Cannot delete stock item. Sales records are linked to this inventory."
             )
         
         # Delete inventory
         db.delete(inventory)
         db.commit()
+        invalidate_response_cache()
         
         return {"message": f"Stock item {stock_id} deleted successfully"}
         
@@ -433,294 +576,198 @@ def delete_stock(stock_id: int):
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        if db:
-            db.close()
 
 @app.get("/get-inventory", response_model=List[InventoryStatus])
-def get_inventory(category: Optional[str] = None):
+def get_inventory(request: Request, category: Optional[str] = None, db: Session = Depends(get_db)):
     """Get inventory, optionally filtered by product category"""
-    db = None
+    cached = get_cached_response(("inventory", category), request)
+    if cached:
+        return cached
+    
+    # Captured before the query; if a write invalidates the cache meanwhile, the result isn't cached
+    generation = response_cache_generation()
+    
     try:
-        db = SessionLocal()
-        
-        # Get inventory items, optionally filtered by category
-        query = db.query(Inventory)
+        # Sold meters are stored on each inventory row, so no sales aggregation is needed.
+        # Plain column rows - no ORM objects or identity map for a read-only list
+        query = select(
+            Inventory.id,
+            Inventory.product_category,
+            Inventory.company_name,
+            Inventory.design_code,
+            Inventory.total_thans,
+            Inventory.meters_per_than,
+            Inventory.total_meters,
+            Inventory.cost_price_per_meter,
+            Inventory.total_stock_value,
+            Inventory.sold_meters
+        )
         if category:
-            query = query.filter(Inventory.product_category == category)
-        inventory_items = query.all()
+            query = query.where(Inventory.product_category == category)
         
-        # Calculate sold meters and remaining stock for each item
         result = []
-        for item in inventory_items:
-            # Calculate total sold meters for this inventory item
-            # Check old inventory_id field (backward compatibility) and new separate fields
-            sales_old = db.query(SalesRecord).filter(
-                SalesRecord.inventory_id == item.id
-            ).all()
-            
-            sales_kameez = db.query(SalesRecord).filter(
-                SalesRecord.kameez_inventory_id == item.id
-            ).all()
-            
-            sales_shalwar = db.query(SalesRecord).filter(
-                SalesRecord.shalwar_inventory_id == item.id
-            ).all()
-            
-            sold_meters = Decimal('0')
-            
-            # Old method: count both kameez and shalwar from inventory_id
-            # Only count if new method fields are NULL to avoid double counting
-            for sale in sales_old:
-                # Skip if this sale uses new method (has separate inventory IDs)
-                if sale.kameez_inventory_id is not None or sale.shalwar_inventory_id is not None:
-                    continue
-                    
-                kameez_m = Decimal(str(sale.kameez_meters)) if sale.kameez_meters is not None else Decimal('0')
-                shalwar_m = Decimal(str(sale.shalwar_meters)) if sale.shalwar_meters is not None else Decimal('0')
-                sold_meters += kameez_m + shalwar_m
-            
-            # New method: count only kameez meters from kameez_inventory_id
-            for sale in sales_kameez:
-                kameez_m = Decimal(str(sale.kameez_meters)) if sale.kameez_meters is not None else Decimal('0')
-                sold_meters += kameez_m
-            
-            # New method: count only shalwar meters from shalwar_inventory_id
-            for sale in sales_shalwar:
-                shalwar_m = Decimal(str(sale.shalwar_meters)) if sale.shalwar_meters is not None else Decimal('0')
-                sold_meters += shalwar_m
-            
-            remaining_meters = item.total_meters - sold_meters
-            remaining_stock_value = remaining_meters * item.cost_price_per_meter
-            
-            result.append(InventoryStatus(
-                id=item.id,
-                product_category=item.product_category,
-                company_name=item.company_name,
-                design_code=item.design_code,
-                total_thans=item.total_thans,
-                meters_per_than=item.meters_per_than,
-                total_meters=item.total_meters,
-                cost_price_per_meter=item.cost_price_per_meter,
-                total_stock_value=item.total_stock_value,
-                sold_meters=sold_meters,
+        for item in db.execute(query).mappings():
+            remaining_meters = item["total_meters"] - item["sold_meters"]
+            result.append(InventoryStatus.model_construct(
+                **item,
                 remaining_meters=remaining_meters,
-                remaining_stock_value=remaining_stock_value
+                remaining_stock_value=remaining_meters * item["cost_price_per_meter"]
             ))
         
-        return result
+        return cache_response(("inventory", category), INVENTORY_STATUS_LIST.dump_json(result), INVENTORY_CACHE_TTL, request, generation)
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        if db:
-            db.close()
 
 @app.get("/get-inventory-simple", response_model=List[dict])
-def get_inventory_simple(category: Optional[str] = None):
+def get_inventory_simple(category: Optional[str] = None, db: Session = Depends(get_db)):
     """Simplified inventory list for dropdown selection, optionally filtered by category"""
-    db = None
-    db_temp = None
     try:
-        db = SessionLocal()
-        query = db.query(Inventory)
+        # Remaining meters come from the stored sold meters; only items with stock are returned
+        remaining_meters = Inventory.total_meters - Inventory.sold_meters
+        query = db.query(
+            Inventory.id,
+            Inventory.company_name,
+            Inventory.design_code,
+            remaining_meters
+        ).filter(remaining_meters > 0)
         if category:
             query = query.filter(Inventory.product_category == category)
-        inventory_items = query.all()
         
-        result = []
-        for item in inventory_items:
-            # Calculate remaining meters
-            db_temp = SessionLocal()
-            # Check old inventory_id and new separate fields
-            sales_old = db_temp.query(SalesRecord).filter(
-                SalesRecord.inventory_id == item.id
-            ).all()
-            
-            sales_kameez = db_temp.query(SalesRecord).filter(
-                SalesRecord.kameez_inventory_id == item.id
-            ).all()
-            
-            sales_shalwar = db_temp.query(SalesRecord).filter(
-                SalesRecord.shalwar_inventory_id == item.id
-            ).all()
-            
-            sold_meters = Decimal('0')
-            
-            # Old method - only count if new method fields are NULL
-            for sale in sales_old:
-                # Skip if this sale uses new method (has separate inventory IDs)
-                if sale.kameez_inventory_id is not None or sale.shalwar_inventory_id is not None:
-                    continue
-                    
-                kameez_m = Decimal(str(sale.kameez_meters)) if sale.kameez_meters is not None else Decimal('0')
-                shalwar_m = Decimal(str(sale.shalwar_meters)) if sale.shalwar_meters is not None else Decimal('0')
-                sold_meters += kameez_m + shalwar_m
-            
-            # New method - kameez only
-            for sale in sales_kameez:
-                kameez_m = Decimal(str(sale.kameez_meters)) if sale.kameez_meters is not None else Decimal('0')
-                sold_meters += kameez_m
-            
-            # New method - shalwar only
-            for sale in sales_shalwar:
-                shalwar_m = Decimal(str(sale.shalwar_meters)) if sale.shalwar_meters is not None else Decimal('0')
-                sold_meters += shalwar_m
-            
-            remaining_meters = float(item.total_meters - sold_meters)
-            db_temp.close()
-            db_temp = None
-            
-            if remaining_meters > 0:  # Only return items with stock
-                result.append({
-                    "id": item.id,
-                    "company_name": item.company_name,
-                    "design_code": item.design_code,
-                    "remaining_meters": remaining_meters
-                })
-        
-        return result
+        return [
+            {
+                "id": item_id,
+                "company_name": company_name,
+                "design_code": design_code,
+                "remaining_meters": float(remaining)
+            }
+            for item_id, company_name, design_code, remaining in query.all()
+        ]
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        if db_temp:
-            db_temp.close()
-        if db:
-            db.close()
+
+def build_sale_values(bill, locked_inventory, sold_deltas):
+    """Validate a bill against locked stock and return its sales record column values"""
+    # sold_deltas holds meters already taken from each item in this transaction
+    # (kameez cut from the same item, or earlier bills of a bulk request) and is updated here
+    kameez_company_name = bill.kameez_company_name
+    kameez_design_code = bill.kameez_design_code
+    shalwar_company_name = bill.shalwar_company_name
+    shalwar_design_code = bill.shalwar_design_code
+    
+    # Check and validate kameez inventory if provided
+    if bill.kameez_inventory_id:
+        kameez_inventory = locked_inventory.get(bill.kameez_inventory_id)
+        if not kameez_inventory:
+            raise HTTPException(status_code=404, detail="Kameez inventory item not found")
+        
+        already_taken = sold_deltas.get(bill.kameez_inventory_id, 0)
+        remaining_kameez = kameez_inventory.total_meters - kameez_inventory.sold_meters - already_taken
+        kameez_needed = bill.kameez_meters
+        
+        if kameez_needed > remaining_kameez:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Kameez: Insufficient stock. Available: {remaining_kameez}m, Required: {kameez_needed}m"
+            )
+        
+        sold_deltas[bill.kameez_inventory_id] = already_taken + kameez_needed
+        kameez_company_name = kameez_company_name or kameez_inventory.company_name
+        kameez_design_code = kameez_design_code or kameez_inventory.design_code
+    
+    # Check and validate shalwar inventory if provided
+    if bill.shalwar_inventory_id:
+        shalwar_inventory = locked_inventory.get(bill.shalwar_inventory_id)
+        if not shalwar_inventory:
+            raise HTTPException(status_code=404, detail="Shalwar inventory item not found")
+        
+        already_taken = sold_deltas.get(bill.shalwar_inventory_id, 0)
+        remaining_shalwar = shalwar_inventory.total_meters - shalwar_inventory.sold_meters - already_taken
+        shalwar_needed = bill.shalwar_meters
+        
+        if shalwar_needed > remaining_shalwar:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Shalwar: Insufficient stock. Available: {remaining_shalwar}m, Required: {shalwar_needed}m"
+            )
+        
+        sold_deltas[bill.shalwar_inventory_id] = already_taken + shalwar_needed
+        shalwar_company_name = shalwar_company_name or shalwar_inventory.company_name
+        shalwar_design_code = shalwar_design_code or shalwar_inventory.design_code
+    
+    # Backward compatibility: handle old inventory_id method
+    if bill.inventory_id and not bill.kameez_inventory_id and not bill.shalwar_inventory_id:
+        inventory = locked_inventory.get(bill.inventory_id)
+        if not inventory:
+            raise HTTPException(status_code=404, detail="Inventory item not found")
+        
+        already_taken = sold_deltas.get(bill.inventory_id, 0)
+        total_meters_needed = bill.kameez_meters + bill.shalwar_meters
+        remaining_meters = inventory.total_meters - inventory.sold_meters - already_taken
+        if total_meters_needed > remaining_meters:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Insufficient stock. Available: {remaining_meters}m, Required: {total_meters_needed}m"
+            )
+        
+        sold_deltas[bill.inventory_id] = already_taken + total_meters_needed
+        company_name = bill.company_name or inventory.company_name
+        design_code = bill.design_code or inventory.design_code
+    else:
+        company_name = bill.company_name
+        design_code = bill.design_code
+    
+    # Calculate totals
+    kameez_total = bill.kameez_meters * bill.kameez_rate
+    shalwar_total = bill.shalwar_meters * bill.shalwar_rate
+    grand_total = kameez_total + shalwar_total
+    
+    return {
+        "product_category": bill.product_category,
+        "inventory_id": bill.inventory_id,  # For backward compatibility
+        "kameez_inventory_id": bill.kameez_inventory_id,
+        "shalwar_inventory_id": bill.shalwar_inventory_id,
+        "company_name": company_name,  # For backward compatibility
+        "design_code": design_code,  # For backward compatibility
+        "kameez_company_name": kameez_company_name,
+        "kameez_design_code": kameez_design_code,
+        "shalwar_company_name": shalwar_company_name,
+        "shalwar_design_code": shalwar_design_code,
+        "kameez_meters": bill.kameez_meters,
+        "kameez_rate": bill.kameez_rate,
+        "kameez_total": kameez_total,
+        "shalwar_meters": bill.shalwar_meters,
+        "shalwar_rate": bill.shalwar_rate,
+        "shalwar_total": shalwar_total,
+        "grand_total": grand_total
+    }
+
+def add_sold_meters(locked_inventory, sold_deltas):
+    """Increment the stored sold meters of locked inventory rows (as an SQL increment)"""
+    for inventory_id, meters in sold_deltas.items():
+        locked_inventory[inventory_id].sold_meters = Inventory.sold_meters + meters
 
 @app.post("/create-bill", response_model=BillResponse)
-def create_bill(bill: BillCreate):
-    db = None
+def create_bill(bill: BillCreate, db: Session = Depends(get_db)):
     try:
-        db = SessionLocal()
-        
-        # Handle separate kameez and shalwar inventory
-        kameez_company_name = bill.kameez_company_name
-        kameez_design_code = bill.kameez_design_code
-        shalwar_company_name = bill.shalwar_company_name
-        shalwar_design_code = bill.shalwar_design_code
-        
-        # Check and validate kameez inventory if provided
-        if bill.kameez_inventory_id:
-            kameez_inventory = db.query(Inventory).filter(Inventory.id == bill.kameez_inventory_id).first()
-            if not kameez_inventory:
-                raise HTTPException(status_code=404, detail="Kameez inventory item not found")
-            
-            # Calculate sold kameez meters from this inventory
-            sales_kameez = db.query(SalesRecord).filter(
-                (SalesRecord.kameez_inventory_id == bill.kameez_inventory_id) |
-                ((SalesRecord.inventory_id == bill.kameez_inventory_id) & (SalesRecord.kameez_inventory_id.is_(None)))
-            ).all()
-            
-            sold_kameez_meters = Decimal('0')
-            for sale in sales_kameez:
-                kameez_m = Decimal(str(sale.kameez_meters)) if sale.kameez_meters is not None else Decimal('0')
-                # For old records with inventory_id, count kameez only
-                if sale.kameez_inventory_id is None and sale.inventory_id == bill.kameez_inventory_id:
-                    sold_kameez_meters += kameez_m
-                elif sale.kameez_inventory_id == bill.kameez_inventory_id:
-                    sold_kameez_meters += kameez_m
-            
-            remaining_kameez = kameez_inventory.total_meters - sold_kameez_meters
-            kameez_needed = Decimal(str(bill.kameez_meters))
-            
-            if kameez_needed > remaining_kameez:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"Kameez: Insufficient stock. Available: {remaining_kameez}m, Required: {kameez_needed}m"
-                )
-            
-            kameez_company_name = kameez_company_name or kameez_inventory.company_name
-            kameez_design_code = kameez_design_code or kameez_inventory.design_code
-        
-        # Check and validate shalwar inventory if provided
-        if bill.shalwar_inventory_id:
-            shalwar_inventory = db.query(Inventory).filter(Inventory.id == bill.shalwar_inventory_id).first()
-            if not shalwar_inventory:
-                raise HTTPException(status_code=404, detail="Shalwar inventory item not found")
-            
-            # Calculate sold shalwar meters from this inventory
-            sales_shalwar = db.query(SalesRecord).filter(
-                (SalesRecord.shalwar_inventory_id == bill.shalwar_inventory_id) |
-                ((SalesRecord.inventory_id == bill.shalwar_inventory_id) & (SalesRecord.shalwar_inventory_id.is_(None)))
-            ).all()
-            
-            sold_shalwar_meters = Decimal('0')
-            for sale in sales_shalwar:
-                shalwar_m = Decimal(str(sale.shalwar_meters)) if sale.shalwar_meters is not None else Decimal('0')
-                # For old records with inventory_id, count shalwar only
-                if sale.shalwar_inventory_id is None and sale.inventory_id == bill.shalwar_inventory_id:
-                    sold_shalwar_meters += shalwar_m
-                elif sale.shalwar_inventory_id == bill.shalwar_inventory_id:
-                    sold_shalwar_meters += shalwar_m
-            
-            remaining_shalwar = shalwar_inventory.total_meters - sold_shalwar_meters
-            shalwar_needed = Decimal(str(bill.shalwar_meters))
-            
-            if shalwar_needed > remaining_shalwar:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"Shalwar: Insufficient stock. Available: {remaining_shalwar}m, Required: {shalwar_needed}m"
-                )
-            
-            shalwar_company_name = shalwar_company_name or shalwar_inventory.company_name
-            shalwar_design_code = shalwar_design_code or shalwar_inventory.design_code
-        
-        # Backward compatibility: handle old inventory_id method
-        if bill.inventory_id and not bill.kameez_inventory_id and not bill.shalwar_inventory_id:
-            inventory = db.query(Inventory).filter(Inventory.id == bill.inventory_id).first()
-            if not inventory:
-                raise HTTPException(status_code=404, detail="Inventory item not found")
-            
-            total_meters_needed = Decimal(str(bill.kameez_meters)) + Decimal(str(bill.shalwar_meters))
-            sales = db.query(SalesRecord).filter(SalesRecord.inventory_id == bill.inventory_id).all()
-            sold_meters = Decimal('0')
-            for sale in sales:
-                kameez_m = Decimal(str(sale.kameez_meters)) if sale.kameez_meters is not None else Decimal('0')
-                shalwar_m = Decimal(str(sale.shalwar_meters)) if sale.shalwar_meters is not None else Decimal('0')
-                sold_meters += kameez_m + shalwar_m
-            
-            remaining_meters = inventory.total_meters - sold_meters
-            if total_meters_needed > remaining_meters:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"Insufficient stock. Available: {remaining_meters}m, Required: {total_meters_needed}m"
-                )
-            
-            company_name = bill.company_name or inventory.company_name
-            design_code = bill.design_code or inventory.design_code
-        else:
-            company_name = bill.company_name
-            design_code = bill.design_code
-        
-        # Calculate totals
-        kameez_total = Decimal(str(bill.kameez_meters)) * Decimal(str(bill.kameez_rate))
-        shalwar_total = Decimal(str(bill.shalwar_meters)) * Decimal(str(bill.shalwar_rate))
-        grand_total = kameez_total + shalwar_total
-        
-        # Create sales record
-        sales_record = SalesRecord(
-            product_category=bill.product_category,
-            inventory_id=bill.inventory_id,  # For backward compatibility
-            kameez_inventory_id=bill.kameez_inventory_id,
-            shalwar_inventory_id=bill.shalwar_inventory_id,
-            company_name=company_name,  # For backward compatibility
-            design_code=design_code,  # For backward compatibility
-            kameez_company_name=kameez_company_name,
-            kameez_design_code=kameez_design_code,
-            shalwar_company_name=shalwar_company_name,
-            shalwar_design_code=shalwar_design_code,
-            kameez_meters=Decimal(str(bill.kameez_meters)),
-            kameez_rate=Decimal(str(bill.kameez_rate)),
-            kameez_total=kameez_total,
-            shalwar_meters=Decimal(str(bill.shalwar_meters)),
-            shalwar_rate=Decimal(str(bill.shalwar_rate)),
-            shalwar_total=shalwar_total,
-            grand_total=grand_total
+        # Lock the inventory rows first so concurrent bills can't both pass the stock check
+        # and oversell; the lock is held until the sale below is committed
+        locked_inventory = lock_inventory_items(
+            db, [bill.kameez_inventory_id, bill.shalwar_inventory_id, bill.inventory_id]
         )
         
+        # Meters this bill takes from each inventory item, added to its sold_meters below
+        sold_deltas = {}
+        sale = build_sale_values(bill, locked_inventory, sold_deltas)
+        sales_record = SalesRecord(**sale)
+        sales_record.line_items = [SalesLineItem(**line_item) for line_item in sale_line_items(sale)]
         db.add(sales_record)
+        
+        # Update the stored sold meters in the same transaction
+        add_sold_meters(locked_inventory, sold_deltas)
+        
         db.commit()
+        invalidate_response_cache()
         db.refresh(sales_record)
         
         return sales_record
@@ -729,108 +776,100 @@ def create_bill(bill: BillCreate):
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        if db:
-            db.close()
 
-@app.get("/get-profit-loss")
-def get_profit_loss(category: Optional[str] = None):
-    """Calculate profit/loss per design, optionally filtered by category"""
-    db = None
+@app.post("/create-bills-bulk", response_model=List[BillResponse])
+def create_bills_bulk(bills: List[BillCreate], db: Session = Depends(get_db)):
+    """Create several bills in one transaction with a single multi-row INSERT"""
+    if not bills:
+        raise HTTPException(status_code=400, detail="No bills provided")
+    
     try:
-        db = SessionLocal()
+        # Lock every inventory row any of the bills touches, once
+        locked_inventory = lock_inventory_items(
+            db,
+            [inventory_id for bill in bills
+             for inventory_id in (bill.kameez_inventory_id, bill.shalwar_inventory_id, bill.inventory_id)]
+        )
+        
+        # Stock checks are cumulative: each bill sees the meters taken by the bills before it.
+        # If any bill fails, nothing is saved.
+        sold_deltas = {}
+        rows = [build_sale_values(bill, locked_inventory, sold_deltas) for bill in bills]
+        
+        # RETURNING rows come back in the order the bills were sent
+        sales_records = db.scalars(
+            insert(SalesRecord).returning(SalesRecord, sort_by_parameter_order=True), rows
+        ).all()
+        line_items = [
+            {"sale_id": record.id, **line_item}
+            for record, row in zip(sales_records, rows)
+            for line_item in sale_line_items(row)
+        ]
+        if line_items:
+            db.execute(insert(SalesLineItem), line_items)
+        add_sold_meters(locked_inventory, sold_deltas)
+        
+        # Build the response from the RETURNING rows now; commit expires them and
+        # reading them afterwards would reload each record with its own SELECT
+        response = [BillResponse.model_validate(record) for record in sales_records]
+        
+        db.commit()
+        invalidate_response_cache()
+        
+        return response
         
-        # Get inventory items, optionally filtered by category
-        query = db.query(Inventory)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/get-profit-loss", response_model=List[ProfitLossItem])
+def get_profit_loss(request: Request, category: Optional[str] = None, db: Session = Depends(get_db)):
+    """Calculate profit/loss per design, optionally filtered by category"""
+    cached = get_cached_response(("profit_loss", category), request)
+    if cached:
+        return cached
+    
+    generation = response_cache_generation()
+    
+    try:
+        # Meters sold, revenue, cost and profit per inventory item, all computed in one query
+        # Derived values are typed as unscaled Numeric so they aren't rounded to the columns' 2 places
+        total_cost = type_coerce(SALES_TOTALS.c.sold_meters * Inventory.cost_price_per_meter, Numeric())
+        profit = type_coerce(SALES_TOTALS.c.revenue - total_cost, Numeric())
+        query = db.query(
+            Inventory.company_name,
+            Inventory.design_code,
+            SALES_TOTALS.c.sold_meters.label("meters_sold"),
+            Inventory.cost_price_per_meter,
+            total_cost.label("total_cost"),
+            SALES_TOTALS.c.revenue.label("total_revenue"),
+            profit.label("profit"),
+            type_coerce(case((total_cost > 0, profit / total_cost * 100), else_=0), Numeric()).label("profit_percentage")
+        ).join(
+            SALES_TOTALS, SALES_TOTALS.c.inventory_id == Inventory.id
+        ).filter(SALES_TOTALS.c.sold_meters > 0)  # Only include items with sales
         if category:
             query = query.filter(Inventory.product_category == category)
-        inventory_items = query.all()
         
-        result = []
-        for item in inventory_items:
-            # Get all sales for this inventory item - check all possible links
-            # Old method: inventory_id
-            sales_old = db.query(SalesRecord).filter(
-                SalesRecord.inventory_id == item.id
-            ).all()
-            
-            # New method: kameez_inventory_id
-            sales_kameez = db.query(SalesRecord).filter(
-                SalesRecord.kameez_inventory_id == item.id
-            ).all()
-            
-            # New method: shalwar_inventory_id
-            sales_shalwar = db.query(SalesRecord).filter(
-                SalesRecord.shalwar_inventory_id == item.id
-            ).all()
-            
-            total_revenue = Decimal('0')
-            total_cost = Decimal('0')
-            total_meters_sold = Decimal('0')
-            
-            # Process old method sales (both kameez and shalwar count)
-            # Only count sales where kameez_inventory_id and shalwar_inventory_id are NULL
-            # to avoid double counting with new method
-            for sale in sales_old:
-                # Skip if this sale uses new method (has separate inventory IDs)
-                if sale.kameez_inventory_id is not None or sale.shalwar_inventory_id is not None:
-                    continue
-                    
-                kameez_m = Decimal(str(sale.kameez_meters)) if sale.kameez_meters is not None else Decimal('0')
-                shalwar_m = Decimal(str(sale.shalwar_meters)) if sale.shalwar_meters is not None else Decimal('0')
-                meters_sold = kameez_m + shalwar_m
-                revenue = sale.grand_total if sale.grand_total is not None else Decimal('0')
-                cost = meters_sold * item.cost_price_per_meter
-                
-                total_revenue += revenue
-                total_cost += cost
-                total_meters_sold += meters_sold
-            
-            # Process kameez sales (only kameez meters count)
-            for sale in sales_kameez:
-                kameez_m = Decimal(str(sale.kameez_meters)) if sale.kameez_meters is not None else Decimal('0')
-                # Only count revenue portion for kameez
-                revenue_per_meter = sale.kameez_rate if sale.kameez_rate is not None else Decimal('0')
-                revenue = kameez_m * revenue_per_meter
-                cost = kameez_m * item.cost_price_per_meter
-                
-                total_revenue += revenue
-                total_cost += cost
-                total_meters_sold += kameez_m
-            
-            # Process shalwar sales (only shalwar meters count)
-            for sale in sales_shalwar:
-                shalwar_m = Decimal(str(sale.shalwar_meters)) if sale.shalwar_meters is not None else Decimal('0')
-                # Only count revenue portion for shalwar
-                revenue_per_meter = sale.shalwar_rate if sale.shalwar_rate is not None else Decimal('0')
-                revenue = shalwar_m * revenue_per_meter
-                cost = shalwar_m * item.cost_price_per_meter
-                
-                total_revenue += revenue
-                total_cost += cost
-                total_meters_sold += shalwar_m
-            
-            profit = total_revenue - total_cost
-            
-            if total_meters_sold > 0:  # Only include items with sales
-                result.append({
-                    "company_name": item.company_name,
-                    "design_code": item.design_code,
-                    "meters_sold": float(total_meters_sold),
-                    "cost_price_per_meter": float(item.cost_price_per_meter),
-                    "total_cost": float(total_cost),
-                    "total_revenue": float(total_revenue),
-                    "profit": float(profit),
-                    "profit_percentage": float((profit / total_cost * 100)) if total_cost > 0 else 0
-                })
-        
-        return result
+        result = [
+            {
+                "company_name": row.company_name,
+                "design_code": row.design_code,
+                "meters_sold": float(row.meters_sold),
+                "cost_price_per_meter": float(row.cost_price_per_meter),
+                "total_cost": float(row.total_cost),
+                "total_revenue": float(row.total_revenue),
+                "profit": float(row.profit),
+                "profit_percentage": float(row.profit_percentage)
+            }
+            for row in query.all()
+        ]
+        
+        return cache_response(("profit_loss", category), orjson.dumps(result), PROFIT_LOSS_CACHE_TTL, request, generation)
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        if db:
-            db.close()
 
 @app.get("/api")
 def read_root():
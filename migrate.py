@@ -0,0 +1,187 @@
+"""
+Database migration script - run once per deploy, before the web workers start
+Creates missing tables, then adds new columns and indexes to existing ones
+
+Usage: python migrate.py
+       python migrate.py --reconcile  (once after a deploy is live, see reconcile_sales)
+"""
+
+import sys
+from sqlalchemy import text, select, insert, update, func, exists, union_all
+from main import engine, Base, Inventory, SalesRecord, SalesLineItem, SALES_TOTALS
+
+def unmigrated_line_items(inventory_id, meters, rate, *conditions):
+    """Line item values for one piece of every sale that has no line items yet"""
+    return select(
+        SalesRecord.id,
+        inventory_id,
+        func.coalesce(meters, 0),
+        func.coalesce(rate, 0)
+    ).where(
+        inventory_id.is_not(None),
+        *conditions,
+        ~exists().where(SalesLineItem.sale_id == SalesRecord.id)
+    )
+
+def backfill_line_items(conn):
+    """Add line items for sales that don't have any yet (same rules as sale_line_items in main.py)"""
+    # Sales written by a release without line items: before this table existed, or by the
+    # previous release while a deploy was switching over. Sales that have line items are skipped.
+    # Old method: both pieces are cut from inventory_id and the new fields are NULL
+    old_method = (SalesRecord.kameez_inventory_id.is_(None), SalesRecord.shalwar_inventory_id.is_(None))
+    backfilled = conn.execute(insert(SalesLineItem).from_select(
+        ["sale_id", "inventory_id", "meters", "rate"],
+        union_all(
+            unmigrated_line_items(SalesRecord.kameez_inventory_id, SalesRecord.kameez_meters, SalesRecord.kameez_rate),
+            unmigrated_line_items(SalesRecord.shalwar_inventory_id, SalesRecord.shalwar_meters, SalesRecord.shalwar_rate),
+            unmigrated_line_items(SalesRecord.inventory_id, SalesRecord.kameez_meters, SalesRecord.kameez_rate, *old_method),
+            unmigrated_line_items(SalesRecord.inventory_id, SalesRecord.shalwar_meters, SalesRecord.shalwar_rate, *old_method)
+        )
+    )).rowcount
+    if backfilled:
+        print(f"✓ Backfilled {backfilled} sales line items")
+
+def reconcile_sold_meters(conn):
+    """Recompute every inventory item's stored sold meters from its sales line items"""
+    # Repairs bills that were given line items by backfill_line_items but never incremented
+    # sold_meters (written by a release without the counter). Lock the rows in a separate
+    # statement first (same id order as create-bill): at READ COMMITTED the UPDATE then gets a
+    # fresh snapshot with every bill committed while we waited, and bills still waiting on the
+    # locks add their meters on top of the recomputed value
+    conn.execute(select(Inventory.id).order_by(Inventory.id).with_for_update()).all()
+    conn.execute(update(Inventory).values(sold_meters=func.coalesce(
+        select(SALES_TOTALS.c.sold_meters)
+        .where(SALES_TOTALS.c.inventory_id == Inventory.id)
+        .scalar_subquery(),
+        0
+    )))
+    print("✓ Inventory sold meters reconciled with sales")
+
+def reconcile_sales():
+    """Catch up on sales the previous release wrote while the deploy was switching over"""
+    # migrate.py runs before cutover, while the old release is still taking bills; a release
+    # that doesn't write line items or sold_meters (the first deploy with sales_line_items)
+    # leaves those bills out of profit/loss and remaining stock. Run this once the new release
+    # is serving; it is safe with live traffic.
+    with engine.begin() as conn:
+        backfill_line_items(conn)
+        reconcile_sold_meters(conn)
+    print("✓ Sales reconciled")
+
+# Migration function to add new columns if they don't exist
+def migrate_database():
+    """Add new columns to sales_records table if they don't exist"""
+    try:
+        with engine.begin() as conn:
+            # Check existing columns
+            result = conn.execute(text("""
+                SELECT column_name 
+                FROM information_schema.columns 
+                WHERE table_name='sales_records'
+            """))
+            existing_columns = [row[0] for row in result.fetchall()]
+            
+            columns_to_add = {
+                'inventory_id': 'INTEGER REFERENCES inventory(id)',
+                'company_name': 'VARCHAR(255)',
+                'design_code': 'VARCHAR(100)',
+                'kameez_inventory_id': 'INTEGER REFERENCES inventory(id)',
+                'shalwar_inventory_id': 'INTEGER REFERENCES inventory(id)',
+                'kameez_company_name': 'VARCHAR(255)',
+                'kameez_design_code': 'VARCHAR(100)',
+                'shalwar_company_name': 'VARCHAR(255)',
+                'shalwar_design_code': 'VARCHAR(100)',
+                'product_category': 'VARCHAR(50) DEFAULT \'two_piece_suits\''
+            }
+            
+            # Also add product_category to inventory table
+            inv_result = conn.execute(text("""
+                SELECT column_name, is_generated 
+                FROM information_schema.columns 
+                WHERE table_name='inventory'
+            """))
+            inv_generated = {row[0]: row[1] for row in inv_result.fetchall()}
+            inv_existing_columns = list(inv_generated)
+            
+            # total_meters / total_stock_value used to be plain columns filled in by the API;
+            # recreate them as generated columns (values are recomputed from the base columns)
+            if inv_generated.get('total_meters') == 'NEVER':
+                conn.execute(text("""
+                    ALTER TABLE inventory
+                        DROP COLUMN total_meters,
+                        DROP COLUMN total_stock_value,
+                        ADD COLUMN total_meters NUMERIC(10, 2)
+                            GENERATED ALWAYS AS (total_thans * meters_per_than) STORED,
+                        ADD COLUMN total_stock_value NUMERIC(10, 2)
+                            GENERATED ALWAYS AS (total_thans * meters_per_than * cost_price_per_meter) STORED
+                """))
+                print("✓ Converted inventory totals to generated columns")
+            
+            if 'product_category' not in inv_existing_columns:
+                try:
+                    conn.execute(text("ALTER TABLE inventory ADD COLUMN product_category VARCHAR(50) DEFAULT 'two_piece_suits'"))
+                    print("✓ Added product_category to inventory table")
+                except Exception as e:
+                    if "already exists" not in str(e).lower():
+                        print(f"⚠ Warning adding product_category to inventory: {str(e)}")
+            
+            added_columns = []
+            for col_name, col_type in columns_to_add.items():
+                if col_name not in existing_columns:
+                    try:
+                        conn.execute(text(f"ALTER TABLE sales_records ADD COLUMN {col_name} {col_type}"))
+                        added_columns.append(col_name)
+                    except Exception as e:
+                        if "already exists" not in str(e).lower():
+                            print(f"⚠ Warning adding {col_name}: {str(e)}")
+            
+            if added_columns:
+                print(f"✓ Database migration completed: Added columns {', '.join(added_columns)}")
+            else:
+                print("✓ Database is up to date - all columns exist")
+            
+            # Line items for sales recorded before sales_line_items existed
+            backfill_line_items(conn)
+            
+            # Stored sold meters
+            if 'sold_meters' not in inv_existing_columns:
+                conn.execute(text("ALTER TABLE inventory ADD COLUMN sold_meters NUMERIC(10, 2) NOT NULL DEFAULT 0"))
+                print("✓ Added sold_meters to inventory table")
+            
+            # Recompute sold meters from the (just backfilled) sales line items
+            reconcile_sold_meters(conn)
+            
+            # Indexes for the sales lookups by inventory id
+            indexes_to_add = {
+                'ix_sales_records_inventory_id': 'sales_records (inventory_id) WHERE inventory_id IS NOT NULL',
+                'ix_sales_records_kameez_inventory_id': 'sales_records (kameez_inventory_id)',
+                'ix_sales_records_shalwar_inventory_id': 'sales_records (shalwar_inventory_id)'
+            }
+            for index_name, index_def in indexes_to_add.items():
+                conn.execute(text(f"CREATE INDEX IF NOT EXISTS {index_name} ON {index_def}"))
+            
+            # Covering indexes from when the sums read sales_records; they now come from
+            # sales_line_items, so these only added write cost to every bill
+            for index_name in ('ix_sales_records_kameez_inventory_id_meters_rate', 'ix_sales_records_shalwar_inventory_id_meters_rate'):
+                conn.execute(text(f"DROP INDEX IF EXISTS {index_name}"))
+            print("✓ Sales record indexes created/verified")
+    except Exception as e:
+        error_msg = str(e).lower()
+        if "already exists" in error_msg or "duplicate" in error_msg:
+            print("✓ Database is up to date - columns already exist")
+        else:
+            # Fail the release step - the new code can't run on the old schema
+            print(f"✗ Migration failed: {str(e)}")
+            raise
+
+if __name__ == "__main__":
+    if "--reconcile" in sys.argv[1:]:
+        # Post-deploy step - no schema changes
+        reconcile_sales()
+    else:
+        # Create tables first
+        Base.metadata.create_all(bind=engine)
+        print("✓ Database tables created/verified")
+        
+        # Then run migration
+        migrate_database()
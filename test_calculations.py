@@ -4,29 +4,43 @@ Tests all mathematical calculations and business logic
 """
 
 import pytest
-from decimal import Decimal
+from decimal import Decimal, ROUND_HALF_UP
 from fastapi.testclient import TestClient
-from main import app, Inventory, SalesRecord, SessionLocal, engine, Base
+from main import (
+    app, Inventory, SalesRecord, SessionLocal, engine, Base,
+    invalidate_response_cache, response_cache_generation, cache_response, get_cached_response
+)
+from starlette.requests import Request
 from sqlalchemy.orm import sessionmaker
 
-# Create test client - will be created per test to avoid initialization issues
-@pytest.fixture(scope="function")
+# One test client for the whole session - the app and its routes don't change between tests
+@pytest.fixture(scope="session")
 def client():
     """Create a test client"""
     return TestClient(app)
 
+@pytest.fixture(scope="session")
+def test_engine():
+    """Database engine shared by all tests, with the tables created once"""
+    Base.metadata.create_all(bind=engine)
+    return engine
+
 # Test database setup
 @pytest.fixture(scope="function")
-def db_session():
-    """Create a test database session"""
-    Base.metadata.create_all(bind=engine)
+def db_session(test_engine):
+    """Run each test inside a transaction that is rolled back afterwards (no cleanup DELETEs)"""
+    connection = test_engine.connect()
+    transaction = connection.begin()
+    # API sessions join this transaction; their commits only release a savepoint
+    SessionLocal.configure(bind=connection, join_transaction_mode="create_savepoint")
     db = SessionLocal()
     yield db
     db.close()
-    # Clean up test data
-    with engine.begin() as conn:
-        conn.execute(Base.metadata.tables['sales_records'].delete())
-        conn.execute(Base.metadata.tables['inventory'].delete())
+    transaction.rollback()
+    connection.close()
+    SessionLocal.configure(bind=test_engine, join_transaction_mode="conservative_savepoint")
+    # Rows were rolled back behind the API's back, so drop cached responses too
+    invalidate_response_cache()
 
 
 class TestStockCalculations:
@@ -250,6 +264,107 @@ class TestInventoryStatusCalculations:
         expected_value = remaining_meters * cost_per_meter
         assert abs(remaining_stock_value - expected_value) < 0.01
 
+    def test_inventory_simple_remaining_meters(self, db_session, client):
+        """Test: simple list returns remaining_meters and skips sold-out items"""
+        stock_data = {
+            "company_name": "Test Company",
+            "design_code": "D-108",
+            "total_thans": 1.0,
+            "meters_per_than": 20.0,
+            "cost_price_per_meter": 100.0
+        }
+        in_stock_id = client.post("/add-stock", json=stock_data).json()['id']
+        sold_out_id = client.post("/add-stock", json={**stock_data, "design_code": "D-109"}).json()['id']
+
+        # Sell 5 meters from the first item and everything from the second
+        client.post("/create-bill", json={
+            "kameez_inventory_id": in_stock_id,
+            "kameez_meters": 5.0,
+            "kameez_rate": 200.0,
+            "shalwar_meters": 0.0,
+            "shalwar_rate": 0.0
+        })
+        client.post("/create-bill", json={
+            "kameez_inventory_id": sold_out_id,
+            "shalwar_inventory_id": sold_out_id,
+            "kameez_meters": 10.0,
+            "kameez_rate": 200.0,
+            "shalwar_meters": 10.0,
+            "shalwar_rate": 180.0
+        })
+
+        response = client.get("/get-inventory-simple")
+        assert response.status_code == 200
+
+        data = response.json()
+        assert [item['id'] for item in data] == [in_stock_id]
+        assert data[0]['remaining_meters'] == 15.0
+
+    def test_inventory_refreshes_after_sale(self, db_session, client):
+        """Test: cached inventory status is invalidated when a bill is created"""
+        stock_data = {
+            "company_name": "Test Company",
+            "design_code": "D-110",
+            "total_thans": 5.0,
+            "meters_per_than": 20.0,
+            "cost_price_per_meter": 100.0
+        }
+        stock_id = client.post("/add-stock", json=stock_data).json()['id']
+
+        # First read fills the cache
+        item = client.get("/get-inventory").json()[0]
+        assert float(item['sold_meters']) == 0.0
+
+        client.post("/create-bill", json={
+            "kameez_inventory_id": stock_id,
+            "kameez_meters": 4.0,
+            "kameez_rate": 200.0,
+            "shalwar_meters": 0.0,
+            "shalwar_rate": 0.0
+        })
+
+        item = client.get("/get-inventory").json()[0]
+        assert float(item['sold_meters']) == 4.0
+        assert float(item['remaining_meters']) == 96.0
+
+    def test_stale_read_not_cached_after_invalidation(self, db_session, client):
+        """Test: a result read before a write isn't cached once the write has invalidated the cache"""
+        request = Request({"type": "http", "headers": []})
+        generation = response_cache_generation()
+
+        # A bill is committed while the read is still running
+        invalidate_response_cache()
+
+        response = cache_response(("inventory", None), b"[]", 60, request, generation)
+        assert response.body == b"[]"
+        assert get_cached_response(("inventory", None), request) is None
+
+    def test_inventory_gzip_response(self, db_session, client):
+        """Test: cached inventory list is served gzip-compressed only to clients that accept it"""
+        for i in range(5):
+            client.post("/add-stock", json={
+                "company_name": "Test Company",
+                "design_code": f"D-12{i}",
+                "total_thans": 5.0,
+                "meters_per_than": 20.0,
+                "cost_price_per_meter": 100.0
+            })
+
+        # First read fills the cache, second is served from it
+        first = client.get("/get-inventory", headers={"Accept-Encoding": "gzip"})
+        cached = client.get("/get-inventory", headers={"Accept-Encoding": "gzip"})
+        plain = client.get("/get-inventory", headers={"Accept-Encoding": "identity"})
+        refused = client.get("/get-inventory", headers={"Accept-Encoding": "gzip;q=0, identity"})
+
+        assert first.headers["content-encoding"] == "gzip"
+        assert cached.headers["content-encoding"] == "gzip"
+        assert "content-encoding" not in plain.headers
+        assert plain.headers["vary"] == "Accept-Encoding"
+        # q=0 means "not gzip"
+        assert "content-encoding" not in refused.headers
+        assert first.json() == cached.json() == plain.json() == refused.json()
+        assert len(plain.json()) == 5
+
 
 class TestProfitLossCalculations:
     """Test profit/loss calculations"""
@@ -369,6 +484,68 @@ class TestProfitLossCalculations:
         assert abs(profit_percentage - expected_percentage) < 0.01
         assert profit_percentage == 50.0
 
+    def test_profit_loss_refreshes_after_sale(self, db_session, client):
+        """Test: cached profit/loss is invalidated when a bill is created"""
+        stock_data = {
+            "company_name": "Test Company",
+            "design_code": "D-113",
+            "total_thans": 10.0,
+            "meters_per_than": 20.0,
+            "cost_price_per_meter": 100.0
+        }
+        stock_id = client.post("/add-stock", json=stock_data).json()['id']
+        bill_data = {
+            "kameez_inventory_id": stock_id,
+            "kameez_meters": 2.0,
+            "kameez_rate": 150.0,
+            "shalwar_meters": 0.0,
+            "shalwar_rate": 0.0
+        }
+        client.post("/create-bill", json=bill_data)
+
+        # First read fills the cache
+        item = client.get("/get-profit-loss").json()[0]
+        assert item['meters_sold'] == 2.0
+
+        client.post("/create-bill", json=bill_data)
+
+        item = client.get("/get-profit-loss").json()[0]
+        assert item['meters_sold'] == 4.0
+        assert item['total_revenue'] == 600.0
+        assert item['profit'] == 200.0
+
+    def test_profit_loss_excludes_items_without_sales(self, db_session, client):
+        """Test: Items with no sold meters are left out of profit/loss"""
+        stock_data = {
+            "company_name": "Test Company",
+            "design_code": "D-116",
+            "total_thans": 10.0,
+            "meters_per_than": 20.0,
+            "cost_price_per_meter": 100.0
+        }
+        sold_id = client.post("/add-stock", json=stock_data).json()['id']
+        zero_id = client.post("/add-stock", json={**stock_data, "design_code": "D-117"}).json()['id']
+        client.post("/add-stock", json={**stock_data, "design_code": "D-118"})  # never sold
+
+        client.post("/create-bill", json={
+            "kameez_inventory_id": sold_id,
+            "kameez_meters": 2.0,
+            "kameez_rate": 150.0,
+            "shalwar_meters": 0.0,
+            "shalwar_rate": 0.0
+        })
+        # A zero-meter bill links a sale to the item but sells nothing from it
+        client.post("/create-bill", json={
+            "kameez_inventory_id": zero_id,
+            "kameez_meters": 0.0,
+            "kameez_rate": 150.0,
+            "shalwar_meters": 0.0,
+            "shalwar_rate": 0.0
+        })
+
+        result = client.get("/get-profit-loss").json()
+        assert [item['design_code'] for item in result] == ["D-116"]
+
 
 class TestEdgeCases:
     """Test edge cases and boundary conditions"""
@@ -402,9 +579,10 @@ class TestEdgeCases:
         assert response.status_code == 200
         
         data = response.json()
-        # Use Decimal for precise calculation (same as backend)
-        expected_meters = Decimal('0.01') * Decimal('0.5')  # 0.005
-        expected_value = expected_meters * Decimal('0.25')  # 0.00125
+        # Use Decimal for precise calculation (same as backend); the Numeric(10, 2)
+        # columns store the totals rounded to 2 places
+        expected_meters = (Decimal('0.01') * Decimal('0.5')).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)  # 0.01
+        expected_value = (Decimal('0.01') * Decimal('0.5') * Decimal('0.25')).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)  # 0.00
         
         # Handle string conversion from Pydantic Decimal serialization
         total_meters = float(data['total_meters']) if isinstance(data['total_meters'], str) else data['total_meters']
@@ -426,16 +604,17 @@ class TestEdgeCases:
         stock_response = client.post("/add-stock", json=stock_data)
         stock_id = stock_response.json()['id']
         
-        # Make 3 sales
-        for i in range(3):
-            bill_data = {
-                "kameez_inventory_id": stock_id,
-                "kameez_meters": 5.0,
-                "kameez_rate": 200.0,
-                "shalwar_meters": 0.0,
-                "shalwar_rate": 0.0
-            }
-            client.post("/create-bill", json=bill_data)
+        # Make 3 sales in one bulk request
+        bill_data = {
+            "kameez_inventory_id": stock_id,
+            "kameez_meters": 5.0,
+            "kameez_rate": 200.0,
+            "shalwar_meters": 0.0,
+            "shalwar_rate": 0.0
+        }
+        bulk_response = client.post("/create-bills-bulk", json=[bill_data] * 3)
+        assert bulk_response.status_code == 200
+        assert len(bulk_response.json()) == 3
         
         response = client.get("/get-inventory")
         item = response.json()[0]
@@ -446,6 +625,11 @@ class TestEdgeCases:
         
         assert sold_meters == 15.0
         assert remaining_meters == total_meters - sold_meters
+        
+        # Bulk bills are counted in profit/loss too
+        profit_item = client.get("/get-profit-loss").json()[0]
+        assert profit_item['meters_sold'] == 15.0
+        assert profit_item['total_revenue'] == 3000.0
 
 
 class TestStockValidation:
@@ -476,6 +660,90 @@ class TestStockValidation:
         assert response.status_code == 400
         assert "Insufficient stock" in response.json()['detail']
 
+    def test_delete_stock_with_sales_blocked(self, db_session, client):
+        """Test: Stock linked to sales cannot be deleted, unsold stock can"""
+        stock_data = {
+            "company_name": "Test Company",
+            "design_code": "D-111",
+            "total_thans": 5.0,
+            "meters_per_than": 20.0,
+            "cost_price_per_meter": 100.0
+        }
+        sold_id = client.post("/add-stock", json=stock_data).json()['id']
+        unsold_id = client.post("/add-stock", json={**stock_data, "design_code": "D-112"}).json()['id']
+
+        client.post("/create-bill", json={
+            "shalwar_inventory_id": sold_id,
+            "kameez_meters": 0.0,
+            "kameez_rate": 0.0,
+            "shalwar_meters": 2.5,
+            "shalwar_rate": 180.0
+        })
+
+        response = client.delete(f"/delete-stock/{sold_id}")
+        assert response.status_code == 400
+        assert "Sales records are linked" in response.json()['detail']
+
+        response = client.delete(f"/delete-stock/{unsold_id}")
+        assert response.status_code == 200
+
+    def test_insufficient_stock_same_item_for_both_pieces(self, db_session, client):
+        """Test: Kameez and shalwar cut from the same item are checked against its stock together"""
+        stock_data = {
+            "company_name": "Test Company",
+            "design_code": "D-114",
+            "total_thans": 5.0,
+            "meters_per_than": 20.0,
+            "cost_price_per_meter": 100.0
+        }
+        stock_id = client.post("/add-stock", json=stock_data).json()['id']
+
+        # 100 meters available, 60 + 50 requested
+        bill_data = {
+            "kameez_inventory_id": stock_id,
+            "shalwar_inventory_id": stock_id,
+            "kameez_meters": 60.0,
+            "kameez_rate": 200.0,
+            "shalwar_meters": 50.0,
+            "shalwar_rate": 180.0
+        }
+
+        response = client.post("/create-bill", json=bill_data)
+        assert response.status_code == 400
+        assert "Shalwar: Insufficient stock" in response.json()['detail']
+
+        # Nothing was sold by the rejected bill
+        item = client.get("/get-inventory").json()[0]
+        assert float(item['sold_meters']) == 0.0
+
+    def test_bulk_bills_insufficient_stock_cumulative(self, db_session, client):
+        """Test: Bulk bills are checked against stock together and rejected as a whole"""
+        stock_data = {
+            "company_name": "Test Company",
+            "design_code": "D-115",
+            "total_thans": 5.0,
+            "meters_per_than": 20.0,
+            "cost_price_per_meter": 100.0
+        }
+        stock_id = client.post("/add-stock", json=stock_data).json()['id']
+
+        # 100 meters available, each bill fits on its own but not together
+        bill_data = {
+            "kameez_inventory_id": stock_id,
+            "kameez_meters": 60.0,
+            "kameez_rate": 200.0,
+            "shalwar_meters": 0.0,
+            "shalwar_rate": 0.0
+        }
+
+        response = client.post("/create-bills-bulk", json=[bill_data, bill_data])
+        assert response.status_code == 400
+        assert "Kameez: Insufficient stock" in response.json()['detail']
+
+        # Neither bill was saved
+        item = client.get("/get-inventory").json()[0]
+        assert float(item['sold_meters']) == 0.0
+
 
 if __name__ == "__main__":
     print("Running comprehensive calculation tests...")